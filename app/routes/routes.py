@@ -4,6 +4,7 @@ from twilio.twiml.messaging_response import MessagingResponse
 
 from app.settings.config import Config
 from app.utils.rate_limiter import rate_limiter
+from app.utils.idempotency import idempotency_guard, DUPLICATE_FILTER
 from app.utils.twilio_validator import validate_twilio_request
 from app.services.message_processor import process_incoming
 from app.services.twilio_client import send_whatsapp_message
@@ -23,6 +24,44 @@ RESPONSE_MESSAGES = {
 def whatsapp_webhook():
     validate_twilio_request()
 
+    # Twilio retries slow/failed webhooks with the same MessageSid; answer those without redoing work
+    message_sid = request.values.get("MessageSid")
+    if message_sid:
+        duplicate_kind, cached_reply = idempotency_guard.claim(message_sid)
+        if duplicate_kind == DUPLICATE_FILTER:
+            # Not in the recent-sid table: a very old retry or a filter false positive
+            logger.warning(f"⚠️ Webhook {message_sid} matched only the idempotency filter, skipping processing")
+        elif duplicate_kind:
+            logger.info(f"♻️ Duplicate webhook for {message_sid} ({duplicate_kind}), skipping processing")
+        if duplicate_kind:
+            response = MessagingResponse()
+            if cached_reply:
+                response.message(cached_reply)
+            return str(response)
+
+    try:
+        response_message = handle_incoming_message()
+    except Exception:
+        # Let Twilio's retry of this MessageSid be processed again
+        if message_sid:
+            idempotency_guard.release(message_sid)
+        raise
+
+    if message_sid:
+        idempotency_guard.complete(message_sid, response_message)
+
+    # Create TwiML response
+    response = MessagingResponse()
+    response.message(response_message)
+    return str(response)
+
+def handle_incoming_message() -> str:
+    """
+    Rate-limit the sender and start background analysis when an image is attached.
+
+    Returns:
+        str: Immediate reply to send back in the TwiML response
+    """
     incoming = request.values.get("Body", "").strip()
     sender = request.values.get("From")
     media_url = request.form.get('MediaUrl0')
@@ -32,9 +71,7 @@ def whatsapp_webhook():
     if not rate_limiter.is_allowed(phone_number):
         wait_time = rate_limiter.get_wait_time(phone_number)
         logger.warning(f"🚫 Rate limited user {phone_number}, wait {wait_time}s")
-        response = MessagingResponse()
-        response.message(f"Please wait {wait_time} seconds before sending another request.")
-        return str(response)
+        return f"Please wait {wait_time} seconds before sending another request."
     
     logger.info(f"📥 Received from {phone_number} - Text: {incoming[:100]}{'...' if len(incoming) > 100 else ''}")
     if media_url:
@@ -86,7 +123,4 @@ def whatsapp_webhook():
     else:
         response_message = RESPONSE_MESSAGES["request_image"]
 
-    # Create TwiML response
-    response = MessagingResponse()
-    response.message(response_message)
-    return str(response)
\ No newline at end of file
+    return response_message
@@ -40,4 +40,21 @@ class Config:
     NUTRITION_PROMPT = os.getenv("NUTRITION_PROMPT")
 
     # Rate limiter configuration
-    RATE_LIMITER_MAX_REQUESTS_PER_MINUTE = int(os.getenv("RATE_LIMITER_MAX_REQUESTS_PER_MINUTE", 5))
\ No newline at end of file
+    RATE_LIMITER_MAX_REQUESTS_PER_MINUTE = int(os.getenv("RATE_LIMITER_MAX_REQUESTS_PER_MINUTE", 5))
+
+    # Webhook idempotency (Twilio retry deduplication) configuration
+    # Seconds each Bloom filter generation covers; a MessageSid is remembered for 1-2 windows
+    IDEMPOTENCY_WINDOW_SECONDS = int(os.getenv("IDEMPOTENCY_WINDOW_SECONDS", 3600))
+    # Expected messages per window, used to size the Bloom filter
+    IDEMPOTENCY_EXPECTED_MESSAGES = int(os.getenv("IDEMPOTENCY_EXPECTED_MESSAGES", 100000))
+    # Acceptable chance of treating a new message as a retry
+    IDEMPOTENCY_FALSE_POSITIVE_RATE = float(os.getenv("IDEMPOTENCY_FALSE_POSITIVE_RATE", 1e-6))
+    # Recent MessageSids kept exactly, with their state and the reply returned for them
+    IDEMPOTENCY_LRU_SIZE = int(os.getenv("IDEMPOTENCY_LRU_SIZE", 10000))
+    # Seconds a retry is suppressed while the original attempt is still being handled;
+    # must exceed Twilio's 15s webhook timeout, since slow-response retries arrive after it
+    IDEMPOTENCY_INFLIGHT_TIMEOUT_SECONDS = float(os.getenv("IDEMPOTENCY_INFLIGHT_TIMEOUT_SECONDS", 30))
+    # Seconds between idempotency stats log lines (duplicates, filter fill, memory)
+    IDEMPOTENCY_STATS_LOG_INTERVAL_SECONDS = int(os.getenv("IDEMPOTENCY_STATS_LOG_INTERVAL_SECONDS", 300))
+    # Optional file shared by all workers (memory-mapped); empty keeps the store in memory
+    IDEMPOTENCY_STORE_PATH = os.getenv("IDEMPOTENCY_STORE_PATH", "")
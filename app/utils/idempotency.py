@@ -0,0 +1,445 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import Lock
+from app.settings.config import Config
+from app.utils.logger import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl, so the file-backed store is unavailable
+    fcntl = None
+
+logger = get_logger(__name__)
+
+# Fallbacks for out-of-range settings (same values as the Config defaults)
+_DEFAULTS = {
+    "IDEMPOTENCY_WINDOW_SECONDS": 3600,
+    "IDEMPOTENCY_EXPECTED_MESSAGES": 100000,
+    "IDEMPOTENCY_FALSE_POSITIVE_RATE": 1e-6,
+    "IDEMPOTENCY_LRU_SIZE": 10000,
+    "IDEMPOTENCY_INFLIGHT_TIMEOUT_SECONDS": 30,
+    "IDEMPOTENCY_STATS_LOG_INTERVAL_SECONDS": 300,
+}
+
+# Store layout: header | Bloom generation 0 | Bloom generation 1 | recent-sid table
+_MAGIC = b"NSIDEMP1"
+_HEADER = struct.Struct("<8sdd9Q")
+_Header = namedtuple(
+    "_Header",
+    "magic rotated_at stats_logged_at active num_bits num_hashes num_slots "
+    "checked replayed in_flight filter_hits active_insertions",
+)
+
+# Table slot: sid digest, state, last update time, reply length, then the reply bytes
+_SLOT = struct.Struct("<16sBdH")
+_REPLY_BYTES = 256
+_SLOT_SIZE = _SLOT.size + _REPLY_BYTES
+_BUCKET_SLOTS = 8
+
+_EMPTY, _IN_FLIGHT, _COMPLETED = 0, 1, 2
+
+# Twilio gives up on a webhook after 15 seconds and retries it, so a retry caused by a slow
+# response arrives at least this long after the original claim
+_TWILIO_WEBHOOK_TIMEOUT_SECONDS = 15
+
+# Duplicate kinds returned by claim()
+DUPLICATE_REPLAYED = "replayed"    # completed, original reply still cached
+DUPLICATE_IN_FLIGHT = "in_flight"  # original attempt still running
+DUPLICATE_FILTER = "filter"        # Bloom filter only: very old retry or false positive
+
+
+def _next_prime(n: int) -> int:
+    """Smallest prime >= n; a prime bit count keeps double-hashed probes from cycling early."""
+    n = max(n, 2)
+    while any(n % d == 0 for d in range(2, math.isqrt(n) + 1)):
+        n += 1
+    return n
+
+
+def _validated(name: str, value, is_valid):
+    """Return value if it passes is_valid, otherwise log it and fall back to the default."""
+    try:
+        if is_valid(value):
+            return value
+    except TypeError:
+        pass
+    logger.error(f"❌ Invalid {name}={value!r}, falling back to {_DEFAULTS[name]}")
+    return _DEFAULTS[name]
+
+
+class WebhookIdempotencyGuard:
+    """
+    Detects Twilio webhook retries by remembering recently seen MessageSids.
+
+    Two layers are used:
+      - A recent-sid table (fixed size, per-bucket LRU eviction) holding each sid's
+        state (in flight / completed) and the reply we returned, so a retry gets the
+        same TwiML message without redoing any work, and failed attempts can run again.
+      - A time-windowed rotating Bloom filter (two generations) of completed sids that
+        bounds memory regardless of traffic and catches retries older than the table.
+
+    When a store path is configured both live in a memory-mapped file, so retries
+    landing on another gunicorn worker are caught too.
+    """
+
+    def __init__(
+        self,
+        window_seconds=Config.IDEMPOTENCY_WINDOW_SECONDS,
+        expected_messages=Config.IDEMPOTENCY_EXPECTED_MESSAGES,
+        false_positive_rate=Config.IDEMPOTENCY_FALSE_POSITIVE_RATE,
+        lru_size=Config.IDEMPOTENCY_LRU_SIZE,
+        inflight_timeout=Config.IDEMPOTENCY_INFLIGHT_TIMEOUT_SECONDS,
+        stats_interval=Config.IDEMPOTENCY_STATS_LOG_INTERVAL_SECONDS,
+        store_path=Config.IDEMPOTENCY_STORE_PATH,
+    ):
+        self.window_seconds = _validated("IDEMPOTENCY_WINDOW_SECONDS", window_seconds, lambda v: v > 0)
+        self.expected_messages = _validated("IDEMPOTENCY_EXPECTED_MESSAGES", expected_messages, lambda v: v > 0)
+        false_positive_rate = _validated("IDEMPOTENCY_FALSE_POSITIVE_RATE", false_positive_rate, lambda v: 0 < v < 1)
+        lru_size = _validated("IDEMPOTENCY_LRU_SIZE", lru_size, lambda v: v > 0)
+        # Must outlast Twilio's webhook timeout, or a retry of a still-running attempt looks stale
+        self.inflight_timeout = _validated(
+            "IDEMPOTENCY_INFLIGHT_TIMEOUT_SECONDS", inflight_timeout, lambda v: v > _TWILIO_WEBHOOK_TIMEOUT_SECONDS
+        )
+        self.stats_interval = _validated("IDEMPOTENCY_STATS_LOG_INTERVAL_SECONDS", stats_interval, lambda v: v > 0)
+
+        # Standard Bloom sizing: m = -n*ln(p) / ln(2)^2, k = (m/n) * ln(2)
+        num_bits = int(math.ceil(-self.expected_messages * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.num_bits = _next_prime(num_bits)
+        self.num_hashes = max(1, int(round(self.num_bits / self.expected_messages * math.log(2))))
+        self.generation_bytes = (self.num_bits + 7) // 8
+
+        self.num_buckets = int(math.ceil(lru_size / _BUCKET_SLOTS))
+        self.num_slots = self.num_buckets * _BUCKET_SLOTS
+        self.table_offset = _HEADER.size + 2 * self.generation_bytes
+        self.table_bytes = self.num_slots * _SLOT_SIZE
+        self.size_bytes = self.table_offset + self.table_bytes
+
+        self.lock = Lock()
+        self.fd = None
+        self.buffer = None
+        self.pid = None
+        self.store_path = None
+
+        if store_path and fcntl is None:
+            logger.warning("⚠️ File-backed idempotency store unsupported on this platform, using memory")
+        elif store_path:
+            # Encode the layout in the file name so workers with different settings never share a file
+            root, ext = os.path.splitext(store_path)
+            self.store_path = f"{root}-{self.num_bits}b{self.num_hashes}k{self.num_slots}s{ext}"
+
+        if self.store_path is None:
+            self._use_memory()
+
+    def _use_memory(self):
+        """Fall back to a per-process in-memory store."""
+        self.store_path = None
+        self.fd = None
+        self.buffer = bytearray(self.size_bytes)
+        self._init_header(time.time())
+
+    def _init_header(self, now: float):
+        self._write_header(_Header(_MAGIC, now, now, 0, self.num_bits, self.num_hashes, self.num_slots, 0, 0, 0, 0, 0))
+
+    def _attach(self):
+        """
+        Open and map the shared store once per process.
+
+        Done lazily rather than at import so that workers forked after import each get
+        their own open file description; otherwise flock would not exclude them.
+        """
+        if self.store_path is None or self.pid == os.getpid():
+            return
+
+        # Drop anything inherited from the parent process
+        if self.buffer is not None:
+            self.buffer.close()
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.buffer = None
+        self.pid = os.getpid()
+
+        try:
+            fd = os.open(self.store_path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            logger.error(f"❌ Cannot open idempotency store {self.store_path}: {e}, using memory")
+            self._use_memory()
+            return
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                buffer = self._map_store(fd)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except (OSError, ValueError) as e:
+            # e.g. a FIFO or special file at the path, a full disk, or mmap ENOMEM
+            logger.error(f"❌ Cannot map idempotency store {self.store_path}: {e}, using memory")
+            buffer = None
+
+        if buffer is None:
+            os.close(fd)
+            self._use_memory()
+            return
+
+        self.fd = fd
+        self.buffer = buffer
+        logger.info(f"🧾 Idempotency store mapped from {self.store_path} ({self.size_bytes} bytes, pid {self.pid})")
+
+    def _map_store(self, fd: int):
+        """Map the store file, initialising it if new. Returns None if it cannot be used."""
+        size = os.fstat(fd).st_size
+        if size == 0:
+            # Fresh file: grow it; an existing file is never resized since other workers map it.
+            # Allocate the blocks up front so a full disk fails here, not as SIGBUS on a later write.
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, self.size_bytes)
+            else:
+                os.ftruncate(fd, self.size_bytes)
+        elif size != self.size_bytes:
+            logger.error(f"❌ Idempotency store {self.store_path} is {size} bytes, expected {self.size_bytes}, using memory")
+            return None
+
+        buffer = mmap.mmap(fd, self.size_bytes)
+        try:
+            header = _Header._make(_HEADER.unpack_from(buffer, 0))
+        except struct.error:
+            buffer.close()
+            raise ValueError("store file is too small to hold a header")
+        if header.magic != _MAGIC:
+            buffer[:] = bytes(self.size_bytes)
+            self.buffer = buffer
+            self._init_header(time.time())
+        elif (header.num_bits, header.num_hashes, header.num_slots) != (self.num_bits, self.num_hashes, self.num_slots):
+            logger.error(f"❌ Idempotency store {self.store_path} has a different layout, using memory")
+            buffer.close()
+            return None
+        return buffer
+
+    @contextmanager
+    def _locked(self):
+        """Serialise access between threads and, when file-backed, between worker processes."""
+        with self.lock:
+            self._attach()
+            if self.fd is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _read_header(self) -> _Header:
+        return _Header._make(_HEADER.unpack_from(self.buffer, 0))
+
+    def _write_header(self, header: _Header):
+        _HEADER.pack_into(self.buffer, 0, *header)
+
+    @staticmethod
+    def _digest(message_sid: str) -> bytes:
+        return hashlib.blake2b(message_sid.encode("utf-8"), digest_size=16).digest()
+
+    def _positions(self, digest: bytes):
+        """Bit positions for a sid digest using Kirsch-Mitzenmacher double hashing."""
+        h1, h2 = struct.unpack("<QQ", digest)
+        h2 = h2 % self.num_bits or 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def _fill_ratio(self, active_insertions: int) -> float:
+        """Estimated fraction of bits set in the active generation."""
+        return 1 - math.exp(-self.num_hashes * active_insertions / self.num_bits)
+
+    def _rotate_if_needed(self, header: _Header, now: float) -> _Header:
+        """
+        Swap generations once the window elapses or the active one reaches its design
+        capacity, clearing the new active generation. Rotating at capacity keeps the
+        false positive rate near the configured value under traffic spikes.
+        """
+        expired = now - header.rotated_at >= self.window_seconds
+        full = header.active_insertions >= self.expected_messages
+        if not (expired or full):
+            return header
+
+        if full and not expired:
+            logger.warning(
+                f"⚠️ Idempotency filter reached capacity ({header.active_insertions} sids in "
+                f"{now - header.rotated_at:.0f}s), rotating early - consider raising IDEMPOTENCY_EXPECTED_MESSAGES"
+            )
+        logger.info(f"🔄 Rotating idempotency filter - {self._format_stats(header)}")
+
+        active = 1 - header.active
+        start = _HEADER.size + active * self.generation_bytes
+        self.buffer[start:start + self.generation_bytes] = bytes(self.generation_bytes)
+        return header._replace(rotated_at=now, active=active, active_insertions=0)
+
+    def _bloom_contains(self, header: _Header, positions) -> bool:
+        for generation in (header.active, 1 - header.active):
+            base = _HEADER.size + generation * self.generation_bytes
+            if all(self.buffer[base + (p >> 3)] & (1 << (p & 7)) for p in positions):
+                return True
+        return False
+
+    def _bloom_add(self, header: _Header, positions):
+        base = _HEADER.size + header.active * self.generation_bytes
+        for p in positions:
+            self.buffer[base + (p >> 3)] |= 1 << (p & 7)
+
+    def _find_slot(self, digest: bytes):
+        """
+        Look up a sid digest in its table bucket.
+
+        Returns:
+            tuple: (offset of the matching slot or None, offset to use for a new entry:
+                    an empty slot if any, else the least recently updated one)
+        """
+        bucket = int.from_bytes(digest[8:], "little") % self.num_buckets
+        base = self.table_offset + bucket * _BUCKET_SLOTS * _SLOT_SIZE
+        empty = None
+        oldest = None
+        oldest_time = None
+        for i in range(_BUCKET_SLOTS):
+            offset = base + i * _SLOT_SIZE
+            key, state, updated_at, _ = _SLOT.unpack_from(self.buffer, offset)
+            if state == _EMPTY:
+                if empty is None:
+                    empty = offset
+            elif key == digest:
+                return offset, offset
+            elif oldest_time is None or updated_at < oldest_time:
+                oldest, oldest_time = offset, updated_at
+        return None, empty if empty is not None else oldest
+
+    def _write_slot(self, offset: int, digest: bytes, state: int, now: float, reply: str = None):
+        encoded = reply.encode("utf-8") if reply else b""
+        if len(encoded) > _REPLY_BYTES:
+            logger.debug(f"Reply of {len(encoded)} bytes too long to cache for retries")
+            encoded = b""
+        _SLOT.pack_into(self.buffer, offset, digest, state, now, len(encoded))
+        start = offset + _SLOT.size
+        self.buffer[start:start + len(encoded)] = encoded
+
+    def _read_reply(self, offset: int):
+        _, _, _, length = _SLOT.unpack_from(self.buffer, offset)
+        if not length:
+            return None
+        start = offset + _SLOT.size
+        return bytes(self.buffer[start:start + length]).decode("utf-8")
+
+    def _log_stats_if_due(self, header: _Header, now: float) -> _Header:
+        """Periodically log shared counters; the timestamp is shared so one worker logs per interval."""
+        if now - header.stats_logged_at < self.stats_interval:
+            return header
+        logger.info(f"📊 Idempotency stats - {self._format_stats(header)}")
+        return header._replace(stats_logged_at=now)
+
+    def claim(self, message_sid: str):
+        """
+        Claim a MessageSid for processing, or report that it was already handled.
+
+        A completed sid, or one still in flight for less than the in-flight timeout, is a
+        duplicate. A released or stale in-flight sid (e.g. the worker died) is claimed again.
+
+        Args:
+            message_sid (str): Twilio MessageSid of the incoming webhook
+
+        Returns:
+            tuple: (duplicate_kind, cached_reply). duplicate_kind is None for a newly
+                   claimed sid, else DUPLICATE_REPLAYED, DUPLICATE_IN_FLIGHT or
+                   DUPLICATE_FILTER. cached_reply is the message returned for the
+                   original request when still known, else None.
+        """
+        digest = self._digest(message_sid)
+        now = time.time()
+
+        with self._locked():
+            header = self._rotate_if_needed(self._read_header(), now)
+            header = header._replace(checked=header.checked + 1)
+            match, free = self._find_slot(digest)
+
+            duplicate_kind, cached_reply = None, None
+            if match is not None:
+                _, state, updated_at, _ = _SLOT.unpack_from(self.buffer, match)
+                if state == _COMPLETED:
+                    duplicate_kind, cached_reply = DUPLICATE_REPLAYED, self._read_reply(match)
+                    header = header._replace(replayed=header.replayed + 1)
+                elif now - updated_at < self.inflight_timeout:
+                    duplicate_kind = DUPLICATE_IN_FLIGHT
+                    header = header._replace(in_flight=header.in_flight + 1)
+            elif self._bloom_contains(header, self._positions(digest)):
+                # Completed long enough ago to have left the table, or a false positive
+                duplicate_kind = DUPLICATE_FILTER
+                header = header._replace(filter_hits=header.filter_hits + 1)
+
+            if duplicate_kind is None:
+                self._write_slot(free, digest, _IN_FLIGHT, now)
+
+            self._write_header(self._log_stats_if_due(header, now))
+
+        return duplicate_kind, cached_reply
+
+    def complete(self, message_sid: str, reply: str):
+        """Mark a claimed MessageSid as handled and store the reply to resend on retries."""
+        digest = self._digest(message_sid)
+        now = time.time()
+
+        with self._locked():
+            header = self._rotate_if_needed(self._read_header(), now)
+            match, free = self._find_slot(digest)
+            self._write_slot(match if match is not None else free, digest, _COMPLETED, now, reply)
+            self._bloom_add(header, self._positions(digest))
+            self._write_header(header._replace(active_insertions=header.active_insertions + 1))
+
+    def release(self, message_sid: str):
+        """Forget a claimed MessageSid whose processing failed, so a retry is processed again."""
+        digest = self._digest(message_sid)
+
+        with self._locked():
+            match, _ = self._find_slot(digest)
+            if match is not None:
+                _SLOT.pack_into(self.buffer, match, bytes(16), _EMPTY, 0.0, 0)
+
+    def _format_stats(self, header: _Header) -> str:
+        duplicates = header.replayed + header.in_flight + header.filter_hits
+        rate = (duplicates / header.checked * 100) if header.checked else 0.0
+        return (
+            f"checked={header.checked}, duplicates={duplicates} ({rate:.2f}%: replayed={header.replayed}, "
+            f"in_flight={header.in_flight}, filter={header.filter_hits}), "
+            f"active={header.active_insertions}/{self.expected_messages} sids "
+            f"(fill {self._fill_ratio(header.active_insertions):.1%}), "
+            f"memory={self.size_bytes} bytes (filter={2 * self.generation_bytes}, table={self.table_bytes})"
+        )
+
+    def get_stats(self) -> dict:
+        """
+        Snapshot of duplicate counters and memory usage.
+
+        Returns:
+            dict: Counters (shared across workers when file-backed) and sizes in bytes
+        """
+        with self._locked():
+            header = self._read_header()
+        duplicates = header.replayed + header.in_flight + header.filter_hits
+        return {
+            "checked": header.checked,
+            "duplicates": duplicates,
+            "duplicate_rate": (duplicates / header.checked) if header.checked else 0.0,
+            "replayed": header.replayed,
+            "in_flight": header.in_flight,
+            "filter_hits": header.filter_hits,
+            "active_insertions": header.active_insertions,
+            "capacity": self.expected_messages,
+            "fill_ratio": self._fill_ratio(header.active_insertions),
+            "filter_bytes": 2 * self.generation_bytes,
+            "table_bytes": self.table_bytes,
+            "memory_bytes": self.size_bytes,
+            "shared": self.fd is not None,
+        }
+
+# Global idempotency guard instance
+idempotency_guard = WebhookIdempotencyGuard()